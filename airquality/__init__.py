@@ -1,73 +1,137 @@
+import os
+from functools import lru_cache, wraps
 from flask import Flask, jsonify
 from flask import request
 from webargs import fields, validate, ValidationError
-from webargs.flaskparser import use_args
-import requests
+from webargs.flaskparser import abort, use_args
+from airquality.upstream import UpstreamError, run_query, cached_query
+from airquality.admission import OverloadError, admission_controller, estimate_cost, estimate_grid_cost
+from airquality.stations import StationIndex, has_coordinates
+from airquality import interpolation
 
 app = Flask(__name__)
 
 # Constants
-sql_api_url = 'https://aasuero.carto.com:443/api/v2/sql'
+# Only trust X-Forwarded-For behind a proxy that sets it, like the heroku router; otherwise clients could spoof it
+trust_forwarded_for = os.environ.get('TRUST_X_FORWARDED_FOR') == '1'
 measurement_variables = ['so2', 'no2', 'co', 'o3', 'pm10', 'pm2_5']
 statistical_measurements = ['avg', 'max', 'min', 'sum', 'count']
+# Sums and counts depend on the number of measurements of each station, so they cannot be interpolated in space
+grid_measurements = ['avg', 'max', 'min']
 steps = ['hour', 'day', 'week']
+geojson_cache_size = 1024  # GeoJSON geometries whose validation result is kept in memory
 
-def get_station_ids():
+def get_stations():
     query=f"""
-    SELECT station_id FROM aasuero.test_airquality_stations
+    SELECT station_id, ST_X(the_geom) as longitude, ST_Y(the_geom) as latitude
+    FROM aasuero.test_airquality_stations
     """
-    response = requests.get(
-        url=sql_api_url,
-        params={
-            'q': query
-        }
-    )
-    body = response.json()
-    return [row['station_id'] for row in body['rows']]
+    body = run_query(query)
+    return body['rows']
+
+stations = get_stations()
+station_ids = [station['station_id'] for station in stations]
+station_index = StationIndex(stations)
+
+def client_id():
+    # The heroku router appends the address of the client to X-Forwarded-For
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if trust_forwarded_for and forwarded_for:
+        return forwarded_for.split(',')[-1].strip()
+    return request.remote_addr
+
+def admit(estimate=estimate_cost):
+    """Runs the handler only once admission control lets the request through, charging it the estimated cost"""
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(args):
+            with admission_controller.admit(client_id(), estimate(args, len(station_ids))):
+                return handler(args)
+        return wrapper
+    return decorator
+
+def cached_response(body, age):
+    if age is None:
+        return body
+    return body, 200, {'Age': str(age), 'Warning': '110 - "Response is Stale"'}
+
+def validate_coordinates(coordinates):
+    if len(coordinates) != 2:
+        raise ValidationError('Must be a longitude and a latitude, separated by comma.')
+    longitude, latitude = coordinates
+    if not -180 <= longitude <= 180 or not -90 <= latitude <= 90:
+        raise ValidationError('Longitude must be between -180 and 180, latitude between -90 and 90.')
+
+def validate_near(args):
+    for param in ['k', 'radius']:
+        if param in args and 'near' not in args:
+            raise ValidationError({param: ['Can only be used together with near.']})
+
+def nearest_stations(args):
+    """Returns {station_id: distance in meters} for the stations requested with near, k and radius"""
+    longitude, latitude = args['near']
+    k = args.get('k', None if 'radius' in args else 1)
+    allowed = set(args['stations']) if 'stations' in args else None
+    return station_index.nearest(longitude, latitude, k=k, radius=args.get('radius'), allowed=allowed)
+
+def with_distances(body, distances):
+    # The cached body is shared between requests, so the rows are copied instead of modified
+    rows = [dict(row, distance=distances[row['station_id']]) for row in body['rows']]
+    rows.sort(key=lambda row: row['distance'])
+    return dict(body, rows=rows)
+
+def validate_bbox(bbox):
+    if len(bbox) != 4:
+        raise ValidationError('Must be min longitude, min latitude, max longitude and max latitude, separated by comma.')
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if not -180 <= min_lon < max_lon <= 180 or not -90 <= min_lat < max_lat <= 90:
+        raise ValidationError('Must be a valid bounding box with longitudes between -180 and 180, latitudes between -90 and 90.')
+
+def stations_bbox():
+    """Returns the bounding box of all stations with coordinates, with a margin of 0.05 degrees"""
+    longitudes = [station['longitude'] for station in stations if has_coordinates(station)]
+    latitudes = [station['latitude'] for station in stations if has_coordinates(station)]
+    return [min(longitudes) - 0.05, min(latitudes) - 0.05, max(longitudes) + 0.05, max(latitudes) + 0.05]
+
+def grid_size(args):
+    """Returns the number of tiles and grid cells a grid request covers, counting whole tiles"""
+    tiles = len(interpolation.tiles_for_bbox(args.get('bbox', stations_bbox())))
+    return tiles, tiles * interpolation.cells_per_tile(args.get('resolution'))
 
-def validate_geojson(geojson):
+def validate_grid(args):
+    # The default bbox around all stations is checked as well, since the stations may be far apart
+    tiles, cells = grid_size(args)
+    if tiles > interpolation.max_tiles or cells > interpolation.max_cells:
+        if 'bbox' in args:
+            raise ValidationError({'bbox': ['The bounding box is too large for the requested resolution.']})
+        raise ValidationError({'bbox': ['The area around all stations is too large. Please provide a bounding box.']})
+
+def grid_cost(args, total_stations):
+    tiles, cells = grid_size(args)
+    area = 0 if 'resolution' in args else tiles * interpolation.tile_size ** 2
+    return estimate_grid_cost(args, total_stations, cells, area)
+
+@lru_cache(maxsize=geojson_cache_size)
+def geojson_errors(geojson):
+    """Returns the errors CARTO reports for a GeoJSON geometry, which are empty if it is valid
+
+    The result is cached, so that each geometry is only sent to CARTO once. Upstream failures are raised instead
+    and not cached.
+    """
     query=f"""
     SELECT ST_GeomFromGeoJSON('{geojson}')
     """
-    response = requests.get(
-        url=sql_api_url,
-        params={
-            'q': query
-        }
-    )
-    body = response.json()
-    if 'error' in body:
-        raise ValidationError(body['error'])
+    body = run_query(query)
+    return tuple(body.get('error', []))
 
-# Measurements endpoint
-@app.route('/measurements', methods=['GET'])
-@use_args(
-    {
-        'variable': fields.Str(
-            required=True,
-            validate=validate.OneOf(measurement_variables)
-        ),
-        'measurement': fields.Str(
-            required=True,
-            validate=validate.OneOf(statistical_measurements)
-        ),
-        'from': fields.DateTime(
-            required=True
-        ),
-        'to': fields.DateTime(
-            required=True
-        ),
-        'stations': fields.DelimitedList(
-            fields.Str(
-                validate=validate.OneOf(get_station_ids())
-            )
-        ),
-        'geom': fields.Str(
-            validate=validate_geojson
-        )
-    },
-    location='query')
-def measurements(args):
+def validate_geom(args):
+    # Called from the handlers rather than while parsing, so that requests with a cached body need no upstream query
+    if 'geom' in args:
+        errors = geojson_errors(args['geom'])
+        if errors:
+            abort(422, messages={'query': {'geom': list(errors)}})
+
+def measurements_query(args):
     query_base = f"""
     SELECT s.station_id, g.population,
     {args['measurement']}(m.{args['variable']}) as {args['measurement']}_{args['variable']}
@@ -94,14 +158,58 @@ def measurements(args):
     query_group = """
     GROUP BY s.station_id, s.the_geom, g.population
     """
-    query = query_base + query_timefilter + query_stationfilter + query_geomfilter + query_group
-    response = requests.get(
-        url=sql_api_url,
-        params={
-            'q': query
-        }
-    )
-    return response.json()
+    return query_base + query_timefilter + query_stationfilter + query_geomfilter + query_group
+
+# Measurements endpoint
+@app.route('/measurements', methods=['GET'])
+@use_args(
+    {
+        'variable': fields.Str(
+            required=True,
+            validate=validate.OneOf(measurement_variables)
+        ),
+        'measurement': fields.Str(
+            required=True,
+            validate=validate.OneOf(statistical_measurements)
+        ),
+        'from': fields.DateTime(
+            required=True
+        ),
+        'to': fields.DateTime(
+            required=True
+        ),
+        'stations': fields.DelimitedList(
+            fields.Str(
+                validate=validate.OneOf(station_ids)
+            )
+        ),
+        'geom': fields.Str(),
+        'near': fields.DelimitedList(
+            fields.Float(),
+            validate=validate_coordinates
+        ),
+        'k': fields.Int(
+            validate=validate.Range(min=1)
+        ),
+        'radius': fields.Float(
+            validate=validate.Range(min=0, min_inclusive=False)
+        )
+    },
+    location='query',
+    validate=validate_near)
+@admit()
+def measurements(args):
+    distances = None
+    if 'near' in args:
+        distances = nearest_stations(args)
+        if not distances:
+            return {'rows': [], 'total_rows': 0}
+        args['stations'] = list(distances)
+    query = measurements_query(args)
+    body, age = cached_query(query, lambda: validate_geom(args))
+    if distances is not None:
+        body = with_distances(body, distances)
+    return cached_response(body, age)
 
 # Timeseries endpoint
 @app.route('/timeseries', methods=['GET'])
@@ -127,15 +235,31 @@ def measurements(args):
         ),
         'stations': fields.DelimitedList(
             fields.Str(
-                validate=validate.OneOf(get_station_ids())
+                validate=validate.OneOf(station_ids)
             )
         ),
-        'geom': fields.Str(
-            validate=validate_geojson
+        'geom': fields.Str(),
+        'near': fields.DelimitedList(
+            fields.Float(),
+            validate=validate_coordinates
+        ),
+        'k': fields.Int(
+            validate=validate.Range(min=1)
+        ),
+        'radius': fields.Float(
+            validate=validate.Range(min=0, min_inclusive=False)
         )
     },
-    location='query')
+    location='query',
+    validate=validate_near)
+@admit()
 def timeseries(args):
+    distances = None
+    if 'near' in args:
+        distances = nearest_stations(args)
+        if not distances:
+            return {'rows': [], 'total_rows': 0}
+        args['stations'] = list(distances)
     query_base = f"""
     SELECT s.station_id, g.population,
     {args['measurement']}(m.{args['variable']}) as {args['measurement']}_{args['variable']},
@@ -164,13 +288,63 @@ def timeseries(args):
     GROUP BY s.station_id, s.the_geom, g.population, interval_start
     """
     query = query_base + query_timefilter + query_stationfilter + query_geomfilter + query_group
-    response = requests.get(
-        url=sql_api_url,
-        params={
-            'q': query
-        }
+    body, age = cached_query(query, lambda: validate_geom(args))
+    if distances is not None:
+        body = with_distances(body, distances)
+    return cached_response(body, age)
+
+# Grid endpoint
+@app.route('/grid', methods=['GET'])
+@use_args(
+    {
+        'variable': fields.Str(
+            required=True,
+            validate=validate.OneOf(measurement_variables)
+        ),
+        'measurement': fields.Str(
+            required=True,
+            validate=validate.OneOf(grid_measurements)
+        ),
+        'from': fields.DateTime(
+            required=True
+        ),
+        'to': fields.DateTime(
+            required=True
+        ),
+        'bbox': fields.DelimitedList(
+            fields.Float(),
+            validate=validate_bbox
+        ),
+        'resolution': fields.Float(
+            validate=validate.Range(min=interpolation.min_resolution, max=interpolation.tile_size)
+        )
+    },
+    location='query',
+    validate=validate_grid)
+@admit(grid_cost)
+def grid(args):
+    body, age = cached_query(measurements_query(args))
+    column = f"{args['measurement']}_{args['variable']}"
+    station_rows = [
+        row for row in body['rows']
+        if row[column] is not None and row['station_id'] in station_index.stations
+    ]
+    station_longitudes = [station_index.stations[row['station_id']]['longitude'] for row in station_rows]
+    station_latitudes = [station_index.stations[row['station_id']]['latitude'] for row in station_rows]
+    station_values = [row[column] for row in station_rows]
+    points = interpolation.interpolate(
+        args.get('bbox', stations_bbox()),
+        args.get('resolution'),
+        station_longitudes,
+        station_latitudes,
+        station_values
     )
-    return response.json()
+    with_population = 'resolution' not in args
+    rows = interpolation.to_rows(points, column, with_population)
+    result = {'rows': rows, 'total_rows': len(rows)}
+    if with_population:
+        result['exposure'] = interpolation.exposure(points)
+    return cached_response(result, age)
 
 # Return validation errors as JSON
 @app.errorhandler(422)
@@ -182,3 +356,9 @@ def handle_error(err):
         return jsonify({'errors': messages}), err.code, headers
     else:
         return jsonify({'errors': messages}), err.code
+
+# Return upstream failures and rejected requests as JSON
+@app.errorhandler(UpstreamError)
+@app.errorhandler(OverloadError)
+def handle_service_error(err):
+    return jsonify({'errors': [str(err)]}), err.code, err.headers
@@ -0,0 +1,184 @@
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+# Constants
+step_hours = {'hour': 1, 'day': 24, 'week': 168}
+cost_scan_hours = 24 * 365  # station-hours of measurements scanned per unit of cost
+cost_rows = 1000  # result rows per unit of cost
+cost_cells = 10000  # interpolated grid cells per unit of cost
+cost_area = 0.25  # square degrees of the demographic grid queried per unit of cost
+# Each gunicorn worker keeps its own buckets and slots. Requests of a client are spread over the workers, so
+# the limits are divided by the number of workers, which gunicorn and heroku take from WEB_CONCURRENCY.
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+bucket_capacity = 60 / workers  # cost a client can spend in a burst
+bucket_rate = 2 / workers  # cost units refilled per second and client
+max_clients = 10000  # token buckets kept in memory
+max_concurrent = 4  # upstream queries running at the same time in a worker
+max_queued = 32  # requests waiting for an upstream slot in a worker
+queue_timeout = 10  # seconds a request waits for an upstream slot
+
+
+class OverloadError(Exception):
+    """Raised when a request is not admitted, either because its client is over its rate or the queue is full"""
+    code = 429
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.headers = {'Retry-After': str(max(1, math.ceil(retry_after)))}
+
+
+def estimate_cost(args, total_stations):
+    """Estimates the upstream cost of a request from its time window, step and number of stations
+
+    The cost grows with the measurements CARTO has to scan (stations times hours in the window) and, for
+    timeseries, with the number of rows it returns (stations times intervals). Every request costs at least 1.
+    """
+    window_hours = max(0, (args['to'] - args['from']).total_seconds() / 3600)
+    station_count = total_stations
+    if 'stations' in args:
+        station_count = len(args['stations'])
+    elif 'k' in args:
+        station_count = min(args['k'], total_stations)
+    cost = 1 + station_count * window_hours / cost_scan_hours
+    if 'step' in args:
+        intervals = math.ceil(window_hours / step_hours[args['step']])
+        cost += station_count * intervals / cost_rows
+    return cost
+
+
+def estimate_grid_cost(args, total_stations, cells, area):
+    """Estimates the cost of a grid request from the station values it needs, the grid cells it interpolates and
+    the area of the demographic grid it queries, if any (in square degrees)
+
+    Querying the demographic grid is one more query to CARTO, whose cost grows with the area.
+    """
+    cost = estimate_cost(args, total_stations) + cells / cost_cells
+    if area:
+        cost += 1 + area / cost_area
+    return cost
+
+
+class TokenBucket:
+    def __init__(self, capacity=bucket_capacity, rate=bucket_rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost):
+        """Takes cost tokens and returns 0, or returns the seconds until enough tokens are available
+
+        A cost above the capacity is capped, so that expensive requests drain the bucket instead of never passing.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """Rate limits each client and caps the number of queries sent to the upstream at the same time
+
+    A request is first charged its cost against the token bucket of its client (admit). Then, every query it
+    sends to the upstream needs a slot (upstream_slot). Queries that find every slot taken wait in a bounded
+    priority queue. Clients with fewer queries in the system go first, and among those, cheaper requests go first,
+    so that a single client sending expensive requests cannot starve everyone else. Requests answered from the
+    cache never take a slot.
+
+    The slots only matter if a worker handles several requests at once, for example with the gthread worker class.
+    """
+
+    def __init__(self, max_concurrent=max_concurrent, max_queued=max_queued, queue_timeout=queue_timeout,
+                 bucket_capacity=bucket_capacity, bucket_rate=bucket_rate, max_clients=max_clients):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.bucket_capacity = bucket_capacity
+        self.bucket_rate = bucket_rate
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.running = 0
+        self.active = Counter()
+        self.queue = []
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.current = threading.local()
+
+    @contextmanager
+    def admit(self, client, cost):
+        """Charges a request to its client, and attributes the upstream queries of this thread to it"""
+        with self.lock:
+            wait = self.bucket(client).take(cost)
+        if wait:
+            raise OverloadError('Too many requests. Please try again later.', wait)
+        self.current.request = (client, cost)
+        try:
+            yield
+        finally:
+            self.current.request = None
+
+    @contextmanager
+    def upstream_slot(self):
+        """Waits for a slot to query the upstream; queries outside of a request count as a single client"""
+        client, cost = getattr(self.current, 'request', None) or ('', 1)
+        self.acquire(client, cost)
+        try:
+            yield
+        finally:
+            self.release(client)
+
+    def acquire(self, client, cost):
+        with self.lock:
+            if self.running < self.max_concurrent and not self.queue:
+                self.running += 1
+                self.active[client] += 1
+                return
+            if len(self.queue) >= self.max_queued:
+                raise OverloadError('The server is busy. Please try again later.', self.queue_timeout)
+            waiter = (self.active[client], cost, next(self.sequence), client, threading.Event())
+            heapq.heappush(self.queue, waiter)
+            self.active[client] += 1
+        if waiter[-1].wait(self.queue_timeout):
+            return
+        with self.lock:
+            if waiter[-1].is_set():
+                return
+            self.queue.remove(waiter)
+            heapq.heapify(self.queue)
+            self.leave(client)
+        raise OverloadError('The server is busy. Please try again later.', self.queue_timeout)
+
+    def release(self, client):
+        with self.lock:
+            self.leave(client)
+            if self.queue:
+                # Hand the slot over to the next waiter instead of freeing it
+                heapq.heappop(self.queue)[-1].set()
+            else:
+                self.running -= 1
+
+    def bucket(self, client):
+        if client not in self.buckets:
+            self.buckets[client] = TokenBucket(self.bucket_capacity, self.bucket_rate)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        self.buckets.move_to_end(client)
+        return self.buckets[client]
+
+    def leave(self, client):
+        self.active[client] -= 1
+        if self.active[client] <= 0:
+            del self.active[client]
+
+
+admission_controller = AdmissionController()
@@ -0,0 +1,168 @@
+import math
+
+import numpy as np
+
+from airquality.stations import earth_radius
+from airquality.upstream import ResponseCache, cache_stale_for, cached_query
+
+# Constants
+tile_size = 0.25  # degrees of longitude and latitude covered by a tile
+max_tiles = 64  # tiles a single request may cover
+max_cells = 100000  # grid cells a single request may cover, counting whole tiles
+min_resolution = 0.001  # degrees
+demographic_cells_per_tile = 800  # upper estimate of 1 km cells in a tile at the latitudes of Spain
+idw_power = 2
+max_station_distance = 20000  # meters from the nearest station beyond which grid cells get no value
+point_dtype = np.dtype([('longitude', '<f4'), ('latitude', '<f4'), ('population', '<u4'), ('value', '<f8')])
+tile_cache_max_bytes = 32 * 1024 * 1024
+
+# Tiles are stored as the raw bytes of an array of point_dtype, 20 bytes per grid cell. They are keyed by the station
+# values they were interpolated from, so they never outlive them and only expire to free memory.
+tile_cache = ResponseCache(max_bytes=tile_cache_max_bytes, stale_for=cache_stale_for)
+
+
+def tiles_for_bbox(bbox):
+    """Returns the (x, y) indices of the tiles that intersect a bbox of (min lon, min lat, max lon, max lat)"""
+    min_x, min_y = math.floor(bbox[0] / tile_size), math.floor(bbox[1] / tile_size)
+    max_x, max_y = math.ceil(bbox[2] / tile_size), math.ceil(bbox[3] / tile_size)
+    return [(x, y) for x in range(min_x, max(max_x, min_x + 1)) for y in range(min_y, max(max_y, min_y + 1))]
+
+
+def tile_bbox(tile):
+    x, y = tile
+    return x * tile_size, y * tile_size, (x + 1) * tile_size, (y + 1) * tile_size
+
+
+def cells_per_side(resolution):
+    """Returns the number of grid cells along each side of a tile, so that a whole number of cells fits into it"""
+    return max(1, round(tile_size / resolution))
+
+
+def cells_per_tile(resolution):
+    """Returns the number of grid cells in a tile, estimated for the demographic grid (resolution None)"""
+    if resolution is None:
+        return demographic_cells_per_tile
+    return cells_per_side(resolution) ** 2
+
+
+def regular_cells(tile, resolution):
+    """Returns the centers of a regular grid over a tile
+
+    The resolution is rounded so that a whole number of cells fits into the tile, which keeps the grid aligned
+    across tiles.
+    """
+    cells = cells_per_side(resolution)
+    min_lon, min_lat, _, _ = tile_bbox(tile)
+    offsets = (np.arange(cells) + 0.5) * tile_size / cells
+    longitudes, latitudes = np.meshgrid(min_lon + offsets, min_lat + offsets)
+    points = np.zeros(cells * cells, dtype=point_dtype)
+    points['longitude'] = longitudes.ravel()
+    points['latitude'] = latitudes.ravel()
+    return points
+
+
+def demographic_cells(tiles):
+    """Returns {tile: cells} with the centers and population of the cells of esp_grid_1km_demographics
+
+    All cells are fetched in a single query over the envelope of the tiles, then assigned to the tile their
+    center lies in.
+    """
+    min_lon = min(tile_bbox(tile)[0] for tile in tiles)
+    min_lat = min(tile_bbox(tile)[1] for tile in tiles)
+    max_lon = max(tile_bbox(tile)[2] for tile in tiles)
+    max_lat = max(tile_bbox(tile)[3] for tile in tiles)
+    query = f"""
+    SELECT ST_X(ST_Centroid(g.the_geom)) as longitude, ST_Y(ST_Centroid(g.the_geom)) as latitude, g.population
+    FROM aasuero.esp_grid_1km_demographics g
+    WHERE g.the_geom && ST_MakeEnvelope({min_lon}, {min_lat}, {max_lon}, {max_lat}, 4326)
+    AND ST_Intersects(ST_Centroid(g.the_geom), ST_MakeEnvelope({min_lon}, {min_lat}, {max_lon}, {max_lat}, 4326))
+    """
+    body, _ = cached_query(query)
+    points = np.zeros(len(body['rows']), dtype=point_dtype)
+    points['longitude'] = [row['longitude'] for row in body['rows']]
+    points['latitude'] = [row['latitude'] for row in body['rows']]
+    points['population'] = [row['population'] or 0 for row in body['rows']]
+    tile_x = np.floor(points['longitude'].astype(float) / tile_size).astype(int)
+    tile_y = np.floor(points['latitude'].astype(float) / tile_size).astype(int)
+    return {tile: points[(tile_x == tile[0]) & (tile_y == tile[1])] for tile in tiles}
+
+
+def idw(longitudes, latitudes, station_longitudes, station_latitudes, station_values):
+    """Interpolates station values at the given points by inverse distance weighting
+
+    Distances between all points and all stations are computed at once as an array of haversine distances.
+    Points that coincide with a station take its value. Points farther than max_station_distance from every
+    station get NaN, since any value there would be an extrapolation.
+    """
+    lon1, lat1 = np.radians(longitudes)[:, None], np.radians(latitudes)[:, None]
+    lon2, lat2 = np.radians(station_longitudes)[None, :], np.radians(station_latitudes)[None, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    distances = 2 * earth_radius * np.arcsin(np.minimum(1, np.sqrt(a)))
+    with np.errstate(divide='ignore'):
+        weights = 1 / distances ** idw_power
+    exact = distances == 0
+    weights = np.where(exact.any(axis=1, keepdims=True), exact.astype(float), weights)
+    values = weights @ station_values / weights.sum(axis=1)
+    return np.where(distances.min(axis=1) <= max_station_distance, values, np.nan)
+
+
+def interpolate(bbox, resolution, station_longitudes, station_latitudes, station_values):
+    """Returns the grid cells within a bbox, interpolated from the station values
+
+    Each cached tile is keyed by the station coordinates and values, the number of cells per tile and the tile.
+    Once the station values change, for example after a stale body was refreshed, the tiles are computed again.
+    """
+    station_longitudes = np.array(station_longitudes, dtype=float)
+    station_latitudes = np.array(station_latitudes, dtype=float)
+    station_values = np.array(station_values, dtype=float)
+    stations_key = (station_longitudes.tobytes(), station_latitudes.tobytes(), station_values.tobytes())
+    grid_key = stations_key + (cells_per_side(resolution) if resolution else None,)
+    tiles = {}
+    for tile in tiles_for_bbox(bbox):
+        entry = tile_cache.get(grid_key + (tile,))
+        tiles[tile] = np.frombuffer(entry[0], dtype=point_dtype) if entry is not None else None
+    missing = [tile for tile, points in tiles.items() if points is None]
+    if missing:
+        if resolution:
+            cells = {tile: regular_cells(tile, resolution) for tile in missing}
+        else:
+            cells = demographic_cells(missing)
+        for tile in missing:
+            points = cells[tile]
+            if len(station_values) and len(points):
+                points['value'] = idw(
+                    points['longitude'].astype(float), points['latitude'].astype(float),
+                    station_longitudes, station_latitudes, station_values
+                )
+            else:
+                points['value'] = np.nan
+            tile_cache.set(grid_key + (tile,), points.tobytes())
+            tiles[tile] = points
+    points = np.concatenate(list(tiles.values()))
+    inside = (
+        (points['longitude'] >= bbox[0]) & (points['latitude'] >= bbox[1])
+        & (points['longitude'] <= bbox[2]) & (points['latitude'] <= bbox[3])
+    )
+    return points[inside]
+
+
+def exposure(points):
+    """Returns the total population of the grid cells and the population-weighted mean of their values"""
+    populated = points[(points['population'] > 0) & ~np.isnan(points['value'])]
+    population = int(populated['population'].sum(dtype=np.int64))
+    mean = None
+    if population:
+        mean = float((populated['population'] * populated['value'].astype(float)).sum() / population)
+    return {'population': population, 'population_weighted_mean': mean}
+
+
+def to_rows(points, column, with_population):
+    """Returns the grid cells as rows, with the interpolated value under column, or None if there is none"""
+    rows = []
+    for longitude, latitude, population, value in points.tolist():
+        row = {'longitude': round(longitude, 5), 'latitude': round(latitude, 5)}
+        if with_population:
+            row['population'] = population
+        row[column] = None if math.isnan(value) else value
+        rows.append(row)
+    return rows
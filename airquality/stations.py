@@ -0,0 +1,90 @@
+import heapq
+import math
+
+# Constants
+earth_radius = 6371008.8  # mean earth radius in meters
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """Returns the great-circle distance between two points in meters"""
+    lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius * math.asin(min(1, math.sqrt(a)))
+
+
+def unit_vector(lon, lat):
+    lon, lat = math.radians(lon), math.radians(lat)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+def chord(distance):
+    """Converts a great-circle distance in meters to the straight-line distance between unit vectors"""
+    return 2 * math.sin(min(math.pi, distance / earth_radius) / 2)
+
+
+def has_coordinates(station):
+    # Stations whose geometry is NULL in CARTO have a longitude and latitude of None
+    return station['longitude'] is not None and station['latitude'] is not None
+
+
+class StationIndex:
+    """KD-tree over the station coordinates, answering nearest-station and radius queries
+
+    Stations are stored as unit vectors in 3D. The straight-line distance between two unit vectors grows with the
+    great-circle distance between the points, so the tree can search with plain euclidean distances and still
+    find the stations that are closest by haversine distance.
+    """
+
+    def __init__(self, stations):
+        """stations is a list of dicts with station_id, longitude and latitude; stations without coordinates are skipped"""
+        stations = [station for station in stations if has_coordinates(station)]
+        self.stations = {station['station_id']: station for station in stations}
+        points = [(unit_vector(station['longitude'], station['latitude']), station['station_id']) for station in stations]
+        self.root = self.build(points, 0)
+
+    def build(self, points, depth):
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda point: point[0][axis])
+        median = len(points) // 2
+        return (
+            points[median],
+            axis,
+            self.build(points[:median], depth + 1),
+            self.build(points[median + 1:], depth + 1)
+        )
+
+    def nearest(self, lon, lat, k=None, radius=None, allowed=None):
+        """Returns {station_id: distance in meters} for the k stations closest to a point
+
+        With a radius (in meters), only stations within it are returned; without k, all of them are. If allowed
+        is given, only those station ids are considered.
+        """
+        target = unit_vector(lon, lat)
+        max_distance = chord(radius) if radius is not None else math.inf
+        found = []  # heap of (-distance, station_id), holding the closest stations seen so far
+        self.search(self.root, target, k, max_distance, allowed, found)
+        distances = {
+            station_id: haversine(lon, lat, self.stations[station_id]['longitude'], self.stations[station_id]['latitude'])
+            for _, station_id in found
+        }
+        return dict(sorted(distances.items(), key=lambda item: item[1]))
+
+    def search(self, node, target, k, max_distance, allowed, found):
+        if node is None:
+            return
+        (point, station_id), axis, left, right = node
+        distance = math.dist(point, target)
+        if distance <= max_distance and (allowed is None or station_id in allowed):
+            heapq.heappush(found, (-distance, station_id))
+            if k is not None and len(found) > k:
+                heapq.heappop(found)
+        offset = target[axis] - point[axis]
+        near, far = (left, right) if offset < 0 else (right, left)
+        self.search(near, target, k, max_distance, allowed, found)
+        bound = max_distance
+        if k is not None and len(found) == k:
+            bound = min(bound, -found[0][0])
+        if abs(offset) <= bound:
+            self.search(far, target, k, max_distance, allowed, found)
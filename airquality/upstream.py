@@ -0,0 +1,244 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import requests
+
+from airquality.admission import OverloadError, admission_controller
+
+# Constants
+sql_api_url = os.environ.get('SQL_API_URL', 'https://aasuero.carto.com:443/api/v2/sql')
+upstream_timeout = 10  # seconds before a CARTO request is abandoned
+breaker_window = 20  # number of recent calls the circuit breaker looks at
+breaker_min_calls = 5  # calls needed in the window before the breaker may open
+breaker_error_rate = 0.5  # share of failed calls that opens the breaker
+breaker_slow_call = 5  # seconds after which a call counts as slow
+breaker_slow_rate = 0.5  # share of slow calls that opens the breaker
+breaker_reset_timeout = 30  # seconds the breaker stays open before a trial call
+cache_fresh_for = 300  # seconds a cached response is served without refreshing
+cache_stale_for = 24 * 3600  # seconds a cached response may be served while refreshing
+cache_max_bytes = 64 * 1024 * 1024  # approximate size of the cached bodies
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamError(Exception):
+    """Raised when the CARTO SQL API fails or returns an unusable response"""
+    code = 502
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.headers = {}
+
+
+class CircuitOpenError(UpstreamError):
+    """Raised instead of calling the CARTO SQL API while the circuit breaker is open"""
+    code = 503
+
+    def __init__(self, retry_after):
+        super().__init__('The CARTO SQL API is currently unavailable. Please try again later.')
+        self.headers = {'Retry-After': str(retry_after)}
+
+
+class CircuitBreaker:
+    """Fails fast once the error rate or the latency of the upstream crosses a threshold
+
+    The breaker remembers the outcome and duration of the most recent calls. When too many of them
+    failed or were slow, it opens and rejects every call for reset_timeout seconds. After that, a
+    single trial call is let through: if it succeeds in time the breaker closes, otherwise it opens again.
+    """
+
+    def __init__(self, window=breaker_window, min_calls=breaker_min_calls, error_rate=breaker_error_rate,
+                 slow_call=breaker_slow_call, slow_rate=breaker_slow_rate, reset_timeout=breaker_reset_timeout):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.reset_timeout = reset_timeout
+        self.calls = deque(maxlen=window)
+        self.state = 'closed'
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def call(self, func, *args):
+        self.before_call()
+        start = time.monotonic()
+        try:
+            result = func(*args)
+        except Exception:
+            # Any failure has to be recorded, otherwise a failed trial call would keep the breaker half-open forever
+            self.record(False, time.monotonic() - start)
+            raise
+        self.record(True, time.monotonic() - start)
+        return result
+
+    def before_call(self):
+        with self.lock:
+            if self.state == 'open':
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    raise CircuitOpenError(math.ceil(remaining))
+                self.state = 'half-open'
+            if self.state == 'half-open':
+                if self.trial_in_flight:
+                    raise CircuitOpenError(1)
+                self.trial_in_flight = True
+
+    def record(self, ok, duration):
+        with self.lock:
+            if self.state == 'open':
+                return
+            if self.state == 'half-open':
+                self.trial_in_flight = False
+                if ok and duration < self.slow_call:
+                    self.state = 'closed'
+                    self.calls.clear()
+                else:
+                    self.open()
+                return
+            self.calls.append((ok, duration))
+            if len(self.calls) < self.min_calls:
+                return
+            failed = sum(1 for call_ok, _ in self.calls if not call_ok)
+            slow = sum(1 for _, call_duration in self.calls if call_duration >= self.slow_call)
+            if failed / len(self.calls) >= self.error_rate or slow / len(self.calls) >= self.slow_rate:
+                self.open()
+
+    def open(self):
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self.calls.clear()
+
+
+class ResponseCache:
+    """In-memory LRU cache of upstream response bodies, keyed by SQL query
+
+    The cache is bounded by the approximate size of the bodies it holds: the length of bytes values, or of the
+    JSON encoding of anything else. Bodies larger than the whole cache are not stored.
+    """
+
+    def __init__(self, max_bytes=cache_max_bytes, stale_for=cache_stale_for):
+        self.max_bytes = max_bytes
+        self.stale_for = stale_for
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (body, age in seconds), or None if there is no usable entry"""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            body, stored_at, _ = self.entries[key]
+            age = time.monotonic() - stored_at
+            if age >= self.stale_for:
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return body, age
+
+    def set(self, key, body):
+        size = len(body) if isinstance(body, bytes) else len(json.dumps(body, default=str))
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (body, time.monotonic(), size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.size -= size
+
+
+breaker = CircuitBreaker()
+cache = ResponseCache()
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+
+def send_query(query):
+    try:
+        response = requests.get(
+            url=sql_api_url,
+            params={
+                'q': query
+            },
+            timeout=upstream_timeout
+        )
+    except requests.RequestException:
+        # The exception contains the url, including the query, which is logged but not shown to clients
+        logger.exception('The CARTO SQL API could not be reached')
+        raise UpstreamError('The CARTO SQL API could not be reached.')
+    if response.status_code >= 500 or response.status_code == 429:
+        raise UpstreamError(f'The CARTO SQL API responded with status {response.status_code}.')
+    try:
+        return response.json()
+    except ValueError:
+        raise UpstreamError('The CARTO SQL API returned an invalid response.')
+
+
+def run_query(query):
+    """Sends a query to the CARTO SQL API through the circuit breaker and returns the response body
+
+    SQL errors reported by CARTO are returned as part of the body, since they do not indicate a problem with the
+    upstream itself.
+    """
+    with admission_controller.upstream_slot():
+        return breaker.call(send_query, query)
+
+
+def fetch_rows(query):
+    body = run_query(query)
+    if 'error' in body:
+        # CARTO errors may quote parts of the query, so they are logged but not shown to clients
+        logger.error('The CARTO SQL API returned an error: %s', '; '.join(body['error']))
+        raise UpstreamError('The CARTO SQL API could not answer the query.')
+    cache.set(query, body)
+    return body
+
+
+def refresh(query):
+    try:
+        fetch_rows(query)
+    except (UpstreamError, OverloadError):
+        pass
+    finally:
+        with refreshing_lock:
+            refreshing.discard(query)
+
+
+def refresh_in_background(query):
+    with refreshing_lock:
+        if query in refreshing:
+            return
+        refreshing.add(query)
+    threading.Thread(target=refresh, args=(query,), daemon=True).start()
+
+
+def cached_query(query, before_fetch=None):
+    """Returns (body, age) for a query, where age is None if the body is fresh
+
+    A cached body older than cache_fresh_for is returned as is, together with its age in seconds, while a
+    background thread fetches a new one. Only queries without a usable cached body wait for the upstream, after
+    calling before_fetch, if given. Checks of the request that need the upstream themselves go there, so that they
+    do not stop a cached body from being served.
+    """
+    entry = cache.get(query)
+    if entry is not None:
+        body, age = entry
+        if age < cache_fresh_for:
+            return body, None
+        refresh_in_background(query)
+        return body, int(age)
+    if before_fetch is not None:
+        before_fetch()
+    return fetch_rows(query), None
@@ -0,0 +1,275 @@
+"""Load test for a running airquality instance
+
+Replays a weighted mix of /measurements and /timeseries requests from several processes, then reports
+throughput, latency percentiles, error rates and the memory used by each server worker. For example:
+
+    python loadtest/run.py --url http://localhost:8000 --processes 4 --concurrency 8 --duration 60 \\
+        --server-pid $(pgrep -o gunicorn) --output results.json
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import requests
+
+polygon = (
+    '{"type":"Polygon","coordinates":[[[-3.63289587199688,40.56439731247202],'
+    '[-3.661734983325005,40.55618117044514],[-3.66310827434063,40.53583209794804],'
+    '[-3.6378740519285206,40.52421992151271],[-3.6148714274168015,40.5239589506112],'
+    '[-3.60543005168438,40.547181381686634],[-3.63289587199688,40.56439731247202]]]}'
+)
+
+# Each scenario is requested with a probability proportional to its weight. If vary_days is set, the time
+# window is shifted by a random number of days, so that not every request is answered from the cache.
+default_mix = [
+    {
+        'name': 'measurements',
+        'weight': 4,
+        'path': '/measurements',
+        'params': {'variable': 'so2', 'measurement': 'avg', 'from': '2017-01-01T00:00:00', 'to': '2017-02-01T00:00:00'},
+        'vary_days': 300
+    },
+    {
+        'name': 'measurements_stations',
+        'weight': 3,
+        'path': '/measurements',
+        'params': {'variable': 'no2', 'measurement': 'max', 'from': '2017-06-01T00:00:00', 'to': '2017-07-01T00:00:00',
+                   'stations': 'aq_jaen,aq_salvia'}
+    },
+    {
+        'name': 'measurements_geom',
+        'weight': 1,
+        'path': '/measurements',
+        'params': {'variable': 'pm10', 'measurement': 'avg', 'from': '2017-06-01T00:00:00', 'to': '2017-07-01T00:00:00',
+                   'geom': polygon}
+    },
+    {
+        'name': 'measurements_near',
+        'weight': 2,
+        'path': '/measurements',
+        'params': {'variable': 'no2', 'measurement': 'avg', 'from': '2017-06-01T00:00:00', 'to': '2017-07-01T00:00:00',
+                   'near': '-3.6400,40.5400', 'k': 3}
+    },
+    {
+        'name': 'grid',
+        'weight': 1,
+        'path': '/grid',
+        'params': {'variable': 'no2', 'measurement': 'avg', 'from': '2017-01-01T00:00:00', 'to': '2017-02-01T00:00:00',
+                   'bbox': '-3.8,40.4,-3.5,40.6'},
+        'vary_days': 30
+    },
+    {
+        'name': 'timeseries_day',
+        'weight': 2,
+        'path': '/timeseries',
+        'params': {'variable': 'o3', 'measurement': 'avg', 'from': '2017-01-01T00:00:00', 'to': '2017-02-01T00:00:00',
+                   'step': 'day'},
+        'vary_days': 300
+    },
+    {
+        'name': 'timeseries_hour_stations',
+        'weight': 1,
+        'path': '/timeseries',
+        'params': {'variable': 'pm2_5', 'measurement': 'max', 'from': '2017-01-01T00:00:00',
+                   'to': '2017-04-01T00:00:00', 'step': 'hour', 'stations': 'aq_jaen,aq_salvia,aq_nevero'},
+        'vary_days': 200
+    },
+    {
+        'name': 'timeseries_week_geom',
+        'weight': 1,
+        'path': '/timeseries',
+        'params': {'variable': 'co', 'measurement': 'min', 'from': '2017-06-01T00:00:00', 'to': '2017-07-01T00:00:00',
+                   'step': 'week', 'geom': polygon}
+    }
+]
+
+
+def request_params(scenario):
+    params = dict(scenario['params'])
+    if scenario.get('vary_days'):
+        offset = timedelta(days=random.randint(0, scenario['vary_days']))
+        for key in ['from', 'to']:
+            params[key] = (datetime.fromisoformat(params[key]) + offset).isoformat()
+    return params
+
+
+def send_requests(url, mix, clients, deadline, interval, results):
+    """Sends requests until the deadline, one every interval seconds, or back to back if interval is None
+
+    Latency is measured from the time a request was scheduled rather than sent, so that a slow server
+    cannot hide its queueing delay by holding back the load generator.
+    """
+    session = requests.Session()
+    weights = [scenario['weight'] for scenario in mix]
+    scheduled = time.monotonic() + (random.random() * interval if interval else 0)
+    while scheduled < deadline:
+        if interval:
+            time.sleep(max(0, scheduled - time.monotonic()))
+        else:
+            scheduled = time.monotonic()
+        scenario = random.choices(mix, weights)[0]
+        # airquality rate limits by client address, which it takes from X-Forwarded-For if TRUST_X_FORWARDED_FOR=1
+        client = random.randrange(clients)
+        headers = {'X-Forwarded-For': f'10.{client // 65536 % 256}.{client // 256 % 256}.{client % 256}'}
+        try:
+            response = session.get(
+                url + scenario['path'], params=request_params(scenario), headers=headers, timeout=60
+            )
+            status = response.status_code
+        except requests.RequestException:
+            status = None
+        results.append((scenario['name'], status, time.monotonic() - scheduled))
+        if interval:
+            scheduled += interval
+
+
+def run_process(url, mix, clients, duration, concurrency, rate):
+    deadline = time.monotonic() + duration
+    interval = concurrency / rate if rate else None
+    results = []
+    threads = [
+        threading.Thread(target=send_requests, args=(url, mix, clients, deadline, interval, results))
+        for _ in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def worker_pids(server_pid):
+    """Returns the pid of the server and of its direct children (the gunicorn workers)"""
+    pids = [server_pid]
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat:
+                parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if parent == server_pid:
+            pids.append(int(entry))
+    return pids
+
+
+def rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def sample_rss(server_pid, stop, samples):
+    while not stop.is_set():
+        for pid in worker_pids(server_pid):
+            rss = rss_mb(pid)
+            if rss is not None:
+                samples[pid].append(rss)
+        stop.wait(1)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(results, duration):
+    latencies = sorted(latency for _, _, latency in results)
+    statuses = Counter('error' if status is None else str(status) for _, status, _ in results)
+    errors = sum(count for status, count in statuses.items() if status == 'error' or int(status) >= 400)
+    return {
+        'requests': len(results),
+        'throughput': len(results) / duration,
+        'latency': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None
+        },
+        'error_rate': errors / len(results) if results else 0,
+        'statuses': dict(statuses)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8000', help='base url of the airquality instance')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to generate load for')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent requests per process')
+    parser.add_argument('--rate', type=float, help='total requests per second; if not set, requests are sent back to back')
+    parser.add_argument('--clients', type=int, default=100, help='number of distinct client addresses to simulate')
+    parser.add_argument('--mix', help='JSON file with the list of scenarios to replay, see default_mix')
+    parser.add_argument('--server-pid', type=int, help='pid of the gunicorn master, to measure the RSS of its workers')
+    parser.add_argument('--label', help='name of the configuration under test, stored in the results')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    mix = default_mix
+    if args.mix:
+        with open(args.mix) as mix_file:
+            mix = json.load(mix_file)
+    process_rate = args.rate / args.processes if args.rate else None
+
+    samples = defaultdict(list)
+    stop = threading.Event()
+    if args.server_pid:
+        sampler = threading.Thread(target=sample_rss, args=(args.server_pid, stop, samples), daemon=True)
+        sampler.start()
+
+    started = time.monotonic()
+    with multiprocessing.Pool(args.processes) as pool:
+        per_process = pool.starmap(
+            run_process,
+            [(args.url, mix, args.clients, args.duration, args.concurrency, process_rate)] * args.processes
+        )
+    duration = time.monotonic() - started
+    stop.set()
+
+    results = [result for process_results in per_process for result in process_results]
+    by_scenario = defaultdict(list)
+    for result in results:
+        by_scenario[result[0]].append(result)
+    report = {
+        'label': args.label,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {key: value for key, value in vars(args).items() if key not in ['output', 'label']},
+        'mix': mix,
+        'total': summarize(results, duration),
+        'scenarios': {name: summarize(scenario_results, duration) for name, scenario_results in by_scenario.items()},
+        'workers': {
+            str(pid): {'rss_mb_max': max(values), 'rss_mb_last': values[-1]}
+            for pid, values in samples.items()
+        }
+    }
+
+    print(f"{'scenario':<28}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>10}")
+    for name, summary in [('total', report['total'])] + sorted(report['scenarios'].items()):
+        latency = {key: (value or 0) * 1000 for key, value in summary['latency'].items()}
+        print(f"{name:<28}{summary['requests']:>10}{summary['throughput']:>10.1f}{latency['p50']:>10.0f}"
+              f"{latency['p95']:>10.0f}{latency['p99']:>10.0f}{summary['error_rate']:>10.1%}")
+    for pid, worker in report['workers'].items():
+        print(f"pid {pid}: max RSS {worker['rss_mb_max']:.1f} MB, last RSS {worker['rss_mb_last']:.1f} MB")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Stand-in for the CARTO SQL API with simulated latency
+
+Answers the queries sent by airquality with made-up rows of the same shape, after waiting for a random
+time drawn from a log-normal distribution. Start it, then point airquality at it:
+
+    python loadtest/upstream.py --port 8001 --latency 0.3
+    SQL_API_URL=http://localhost:8001/api/v2/sql gunicorn airquality:app
+"""
+import argparse
+import json
+import math
+import random
+import re
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+stations = {
+    'aq_jaen': (-3.6343, 40.5423),
+    'aq_salvia': (-3.6362, 40.5486),
+    'aq_nevero': (-3.6201, 40.5302),
+    'aq_uam': (-3.6908, 40.5446),
+    'aq_sim_05': (-3.7038, 40.4168),
+    'aq_sim_06': (-3.6883, 40.4530),
+    'aq_sim_07': (-3.7492, 40.3957),
+    'aq_sim_08': (-3.5676, 40.4893),
+    'aq_sim_09': (-3.8145, 40.4381),
+    'aq_sim_10': (-3.6694, 40.3478)
+}
+station_ids = list(stations)
+geojson_types = [
+    'Point', 'MultiPoint', 'LineString', 'MultiLineString', 'Polygon', 'MultiPolygon', 'GeometryCollection'
+]
+step_hours = {'hour': 1, 'day': 24, 'week': 168}
+max_rows = 10000
+
+
+def station_rows():
+    return [
+        {'station_id': station_id, 'longitude': longitude, 'latitude': latitude}
+        for station_id, (longitude, latitude) in stations.items()
+    ]
+
+
+def validation_rows(query):
+    geojson = re.search(r"ST_GeomFromGeoJSON\('(.*)'\)", query, re.S).group(1)
+    try:
+        geometry = json.loads(geojson)
+    except ValueError:
+        return None
+    if not isinstance(geometry, dict) or geometry.get('type') not in geojson_types:
+        return None
+    return [{'st_geomfromgeojson': '0103000020E6100000'}]
+
+
+def grid_rows(query):
+    min_lon, min_lat, max_lon, max_lat = [
+        float(value) for value in re.search(r'ST_MakeEnvelope\(([^,]+), ([^,]+), ([^,]+), ([^,]+), 4326\)', query).groups()
+    ]
+    rows = []
+    cell = 0.01
+    longitude = min_lon + cell / 2
+    while longitude < max_lon:
+        latitude = min_lat + cell / 2
+        while latitude < max_lat:
+            rows.append({'longitude': longitude, 'latitude': latitude, 'population': random.randint(0, 2000)})
+            latitude += cell
+        longitude += cell
+    return rows
+
+
+def measurement_rows(query):
+    selected = station_ids
+    station_filter = re.search(r'station_id IN \(([^)]*)\)', query)
+    if station_filter:
+        selected = [station_id.strip(" '") for station_id in station_filter.group(1).split(',')]
+    column = re.search(r' as (\w+)', query).group(1)
+    step = re.search(r"date_trunc\('(\w+)'", query)
+    intervals = [None]
+    if step:
+        start, end = [
+            datetime.fromisoformat(value)
+            for value in re.findall(r"timeinstant [<>]=? '([^']*)'", query)
+        ]
+        count = math.ceil(max(0, (end - start).total_seconds()) / 3600 / step_hours[step.group(1)])
+        intervals = range(min(count, max_rows // max(1, len(selected))))
+    rows = []
+    for station_id in selected:
+        for interval in intervals:
+            row = {'station_id': station_id, 'population': random.randint(0, 5000), column: random.random() * 50}
+            if interval is not None:
+                row['interval_start'] = f'interval-{interval}'
+            rows.append(row)
+    return rows
+
+
+class Handler(BaseHTTPRequestHandler):
+    latency = 0.3
+    sigma = 0.5
+    error_rate = 0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query).get('q', [''])[0]
+        time.sleep(random.lognormvariate(math.log(self.latency), self.sigma) if self.latency > 0 else 0)
+        if random.random() < self.error_rate:
+            self.respond(500, {'error': ['simulated upstream failure']})
+        elif 'JOIN' in query:
+            rows = measurement_rows(query)
+            self.respond(200, {'rows': rows, 'total_rows': len(rows)})
+        elif 'ST_MakeEnvelope' in query:
+            rows = grid_rows(query)
+            self.respond(200, {'rows': rows, 'total_rows': len(rows)})
+        elif 'ST_GeomFromGeoJSON' in query:
+            rows = validation_rows(query)
+            if rows is None:
+                self.respond(400, {'error': ['invalid GeoJSON representation']})
+            else:
+                self.respond(200, {'rows': rows, 'total_rows': len(rows)})
+        else:
+            rows = station_rows()
+            self.respond(200, {'rows': rows, 'total_rows': len(rows)})
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.3, help='median latency in seconds')
+    parser.add_argument('--sigma', type=float, default=0.5, help='spread of the log-normal latency distribution')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of queries answered with status 500')
+    args = parser.parse_args()
+    Handler.latency = args.latency
+    Handler.sigma = args.sigma
+    Handler.error_rate = args.error_rate
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f'Simulated CARTO SQL API at http://{args.host}:{args.port}/api/v2/sql')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
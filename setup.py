@@ -9,6 +9,7 @@ setup(
     install_requires=[
         'flask',
         'webargs',
-        'requests'
+        'requests',
+        'numpy'
     ]
 )
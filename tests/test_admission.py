@@ -0,0 +1,200 @@
+import json
+import threading
+from datetime import datetime
+import pytest
+import airquality
+from airquality import upstream
+from airquality.admission import AdmissionController, OverloadError, TokenBucket, estimate_cost
+from airquality.upstream import ResponseCache
+
+@pytest.fixture
+def client():
+    with airquality.app.test_client() as client:
+        yield client
+
+# Cost estimation ------------------------------------------------------------------------------------------------------
+
+def test_cost_grows_with_window():
+    """A longer time window should cost more"""
+    month = {'from': datetime(2017, 6, 1), 'to': datetime(2017, 7, 1)}
+    year = {'from': datetime(2017, 1, 1), 'to': datetime(2018, 1, 1)}
+    assert estimate_cost(year, 10) > estimate_cost(month, 10)
+
+def test_cost_grows_with_stations():
+    """Filtering by fewer stations should cost less than querying all of them"""
+    all_stations = {'from': datetime(2017, 6, 1), 'to': datetime(2017, 7, 1)}
+    one_station = dict(all_stations, stations=['aq_jaen'])
+    assert estimate_cost(one_station, 10) < estimate_cost(all_stations, 10)
+
+def test_cost_grows_with_smaller_step():
+    """An hourly timeseries should cost more than a weekly one"""
+    weekly = {'from': datetime(2017, 6, 1), 'to': datetime(2017, 7, 1), 'step': 'week'}
+    hourly = dict(weekly, step='hour')
+    assert estimate_cost(hourly, 10) > estimate_cost(weekly, 10)
+
+def test_cost_minimum():
+    """Every request should cost at least 1, even for an empty window"""
+    empty = {'from': datetime(2017, 7, 1), 'to': datetime(2017, 6, 1)}
+    assert estimate_cost(empty, 10) == 1
+
+# Token bucket ---------------------------------------------------------------------------------------------------------
+
+def test_bucket_allows_burst():
+    """Requests should pass while the bucket has enough tokens"""
+    bucket = TokenBucket(capacity=10, rate=1)
+    assert bucket.take(4) == 0
+    assert bucket.take(6) == 0
+
+def test_bucket_returns_wait_time():
+    """Once empty, the bucket should return the seconds until enough tokens are available"""
+    bucket = TokenBucket(capacity=10, rate=1)
+    bucket.take(10)
+    assert 4 < bucket.take(5) <= 5
+
+def test_bucket_caps_cost():
+    """A request costing more than the capacity should pass when the bucket is full"""
+    bucket = TokenBucket(capacity=10, rate=1)
+    assert bucket.take(100) == 0
+
+# Admission controller -------------------------------------------------------------------------------------------------
+
+def test_rate_limited_client():
+    """A client over its rate should get a 429 with Retry-After, without affecting other clients"""
+    controller = AdmissionController(bucket_capacity=10, bucket_rate=1)
+    with controller.admit('a', 10):
+        pass
+    with pytest.raises(OverloadError) as err:
+        with controller.admit('a', 5):
+            pass
+    assert err.value.code == 429
+    assert int(err.value.headers['Retry-After']) >= 1
+    with controller.admit('b', 5):
+        pass
+
+def test_upstream_slot_of_request():
+    """Upstream queries within a request should take a slot on behalf of the client of the request"""
+    controller = AdmissionController()
+    with controller.admit('a', 3):
+        with controller.upstream_slot():
+            assert controller.running == 1
+            assert controller.active == {'a': 1}
+    with controller.upstream_slot():
+        assert controller.active == {'': 1}
+    assert controller.running == 0
+
+def test_full_queue():
+    """When all slots are taken and the queue is full, requests should be rejected immediately"""
+    controller = AdmissionController(max_concurrent=1, max_queued=0)
+    controller.acquire('a', 1)
+    with pytest.raises(OverloadError):
+        controller.acquire('b', 1)
+    controller.release('a')
+
+def test_queue_timeout():
+    """A request that waits for a slot for too long should be rejected"""
+    controller = AdmissionController(max_concurrent=1, queue_timeout=0.01)
+    controller.acquire('a', 1)
+    with pytest.raises(OverloadError):
+        controller.acquire('b', 1)
+    assert controller.queue == []
+
+def test_light_client_goes_first():
+    """A waiting client without other requests should get the next slot before a busy client"""
+    controller = AdmissionController(max_concurrent=1, queue_timeout=5)
+    controller.acquire('heavy', 1)
+    order = []
+
+    def request(client):
+        controller.acquire(client, 1)
+        order.append(client)
+        controller.release(client)
+
+    heavy = threading.Thread(target=request, args=('heavy',))
+    heavy.start()
+    while len(controller.queue) < 1:
+        pass
+    light = threading.Thread(target=request, args=('light',))
+    light.start()
+    while len(controller.queue) < 2:
+        pass
+    controller.release('heavy')
+    heavy.join()
+    light.join()
+    assert order == ['light', 'heavy']
+
+# Endpoints ------------------------------------------------------------------------------------------------------------
+
+def test_rate_limited_endpoint(client, monkeypatch):
+    """A client over its rate should get a 429 with a Retry-After header from the endpoints"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00'
+    }
+    monkeypatch.setattr(airquality, 'admission_controller', AdmissionController(bucket_capacity=2, bucket_rate=0.01))
+    monkeypatch.setattr(upstream, 'cache', ResponseCache())
+    monkeypatch.setattr(upstream, 'send_query', lambda query: {'rows': [], 'total_rows': 0})
+    response = client.get('/measurements', query_string=params)
+    assert response.status_code == 200
+    response = client.get('/measurements', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert 'errors' in body
+
+def test_forwarded_for_not_trusted_by_default(client, monkeypatch):
+    """Without TRUST_X_FORWARDED_FOR, a spoofed X-Forwarded-For should not give a client a fresh bucket"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00'
+    }
+    monkeypatch.setattr(airquality, 'admission_controller', AdmissionController(bucket_capacity=2, bucket_rate=0.01))
+    monkeypatch.setattr(upstream, 'cache', ResponseCache())
+    monkeypatch.setattr(upstream, 'send_query', lambda query: {'rows': [], 'total_rows': 0})
+    response = client.get('/measurements', query_string=params, headers={'X-Forwarded-For': '10.0.0.1'})
+    assert response.status_code == 200
+    response = client.get('/measurements', query_string=params, headers={'X-Forwarded-For': '10.0.0.2'})
+    assert response.status_code == 429
+
+def test_rate_limited_before_upstream(client, monkeypatch):
+    """A client over its rate should be rejected before any query is sent upstream, including the geom validation"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'geom': '{"type":"Point","coordinates":[-3.6343,40.5423]}'
+    }
+    queries = []
+    airquality.geojson_errors.cache_clear()
+    monkeypatch.setattr(airquality, 'admission_controller', AdmissionController(bucket_capacity=1, bucket_rate=0.01))
+    monkeypatch.setattr(upstream, 'cache', ResponseCache())
+    monkeypatch.setattr(upstream, 'send_query', lambda query: queries.append(query) or {'rows': [], 'total_rows': 0})
+    assert client.get('/measurements', query_string=params).status_code == 200
+    sent = len(queries)
+    for day in range(2, 6):
+        params['geom'] = f'{{"type":"Point","coordinates":[-3.6343,40.54{day}]}}'
+        assert client.get('/measurements', query_string=params).status_code == 429
+    assert len(queries) == sent
+
+def test_geom_validation_attributed_to_client(client, monkeypatch):
+    """The geom validation query should take an upstream slot on behalf of the client of the request"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'geom': '{"type":"Point","coordinates":[-3.6343,40.5423]}'
+    }
+    clients = []
+    controller = AdmissionController()
+    airquality.geojson_errors.cache_clear()
+    monkeypatch.setattr(airquality, 'admission_controller', controller)
+    monkeypatch.setattr(upstream, 'admission_controller', controller)
+    monkeypatch.setattr(upstream, 'cache', ResponseCache())
+    monkeypatch.setattr(upstream, 'send_query', lambda query: clients.append(set(controller.active)) or {'rows': []})
+    assert client.get('/measurements', query_string=params).status_code == 200
+    assert clients == [{'127.0.0.1'}, {'127.0.0.1'}]
@@ -0,0 +1,217 @@
+from datetime import datetime
+import pytest
+import airquality
+import json
+import numpy as np
+from airquality import interpolation
+from airquality.admission import estimate_grid_cost
+from airquality.interpolation import idw, tiles_for_bbox
+from airquality.upstream import ResponseCache
+
+@pytest.fixture
+def client():
+    with airquality.app.test_client() as client:
+        yield client
+
+# Interpolation --------------------------------------------------------------------------------------------------------
+
+def test_idw_at_station():
+    """A point that coincides with a station should take its value"""
+    values = idw(np.array([-3.6, -3.7]), np.array([40.5, 40.4]), np.array([-3.6, -3.8]), np.array([40.5, 40.4]),
+                 np.array([10.0, 20.0]))
+    assert values[0] == 10.0
+
+def test_idw_between_stations():
+    """Interpolated values should lie between the station values, closer to the value of the nearest station"""
+    values = idw(np.array([-3.62]), np.array([40.5]), np.array([-3.6, -3.8]), np.array([40.5, 40.5]),
+                 np.array([10.0, 20.0]))
+    assert 10.0 < values[0] < 15.0
+
+def test_idw_far_from_stations():
+    """Points farther than max_station_distance from every station should get no value"""
+    values = idw(np.array([-3.6, 10.5]), np.array([40.6, 10.5]), np.array([-3.6]), np.array([40.5]), np.array([10.0]))
+    assert values[0] == 10.0
+    assert np.isnan(values[1])
+
+def test_tiles_for_bbox():
+    """A bbox should be covered by the tiles it intersects"""
+    assert tiles_for_bbox([-3.8, 40.3, -3.6, 40.45]) == [(-16, 161), (-15, 161)]
+
+def test_grid_cost():
+    """Grid requests should cost more with more cells and with a larger area of the demographic grid"""
+    args = {'from': datetime(2017, 6, 1), 'to': datetime(2017, 6, 2)}
+    assert estimate_grid_cost(args, 10, 100000, 0) > estimate_grid_cost(args, 10, 1000, 0)
+    assert estimate_grid_cost(args, 10, 1000, 4) > estimate_grid_cost(args, 10, 1000, 0.25)
+
+def test_demographic_cells_single_query(monkeypatch):
+    """The demographic cells of several tiles should be fetched in one query and split into tiles"""
+    queries = []
+
+    def cached_query(query):
+        queries.append(query)
+        rows = [
+            {'longitude': -3.7, 'latitude': 40.4, 'population': 10},
+            {'longitude': -3.4, 'latitude': 40.4, 'population': 20}
+        ]
+        return {'rows': rows}, None
+
+    monkeypatch.setattr(interpolation, 'cached_query', cached_query)
+    cells = interpolation.demographic_cells([(-15, 161), (-14, 161), (-15, 162)])
+    assert len(queries) == 1
+    assert list(cells[(-15, 161)]['population']) == [10]
+    assert list(cells[(-14, 161)]['population']) == [20]
+    assert len(cells[(-15, 162)]) == 0
+
+def test_tile_key_uses_cell_count(monkeypatch):
+    """Resolutions that round to the same number of cells per tile should share the cached tiles"""
+    monkeypatch.setattr(interpolation, 'tile_cache', ResponseCache())
+    for resolution in [0.05, 0.0501]:
+        interpolation.interpolate([-3.75, 40.5, -3.5, 40.75], resolution, [-3.6], [40.6], [10.0])
+    assert len(interpolation.tile_cache.entries) == 1
+
+def test_tile_key_uses_station_values(monkeypatch):
+    """Tiles interpolated from old station values should not be served once the values change"""
+    monkeypatch.setattr(interpolation, 'tile_cache', ResponseCache())
+    bbox = [-3.75, 40.5, -3.5, 40.75]
+    old = interpolation.interpolate(bbox, 0.05, [-3.6], [40.6], [10.0])
+    new = interpolation.interpolate(bbox, 0.05, [-3.6], [40.6], [20.0])
+    assert list(old['value']) == pytest.approx([10.0] * 25)
+    assert list(new['value']) == pytest.approx([20.0] * 25)
+
+# Positive tests -------------------------------------------------------------------------------------------------------
+
+def test_demographic_grid(client):
+    """Without resolution, the cells of the demographic grid should be returned with population and exposure"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'bbox': '-3.7,40.5,-3.6,40.6'
+    }
+    response = client.get('/grid', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 200
+    assert body['total_rows'] > 0
+    for row in body['rows']:
+        assert -3.7 <= row['longitude'] <= -3.6 and 40.5 <= row['latitude'] <= 40.6
+        assert 'population' in row and 'avg_so2' in row
+    assert body['exposure']['population'] == sum(row['population'] for row in body['rows'])
+
+def test_regular_grid(client):
+    """With a resolution, a regular grid over the bbox should be returned"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'bbox': '-3.75,40.5,-3.5,40.75',
+        'resolution': 0.05
+    }
+    response = client.get('/grid', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 200
+    assert body['total_rows'] == 25
+    assert 'exposure' not in body
+
+# Negative tests -------------------------------------------------------------------------------------------------------
+
+def test_bbox_too_large(client):
+    """A request with a bbox covering too many tiles should return an error for that parameter"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'bbox': '-10,35,5,44'
+    }
+    response = client.get('/grid', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 422
+    assert 'bbox' in body['errors']['query']
+
+def test_invalid_resolution(client):
+    """A request with a resolution that is too small should return an error for that parameter"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'resolution': 0.00001
+    }
+    response = client.get('/grid', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 422
+    assert 'resolution' in body['errors']['query']
+
+def test_too_many_cells(client):
+    """A request whose tiles hold too many cells at the requested resolution should return an error for bbox"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'bbox': '-3.8,40.4,-3.4,40.6',
+        'resolution': 0.001
+    }
+    response = client.get('/grid', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 422
+    assert 'bbox' in body['errors']['query']
+
+def test_default_bbox_too_large(client, monkeypatch):
+    """Without bbox, the area around all stations should be checked as well"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00'
+    }
+    far_apart = [
+        {'station_id': 'a', 'longitude': -9.0, 'latitude': 36.0},
+        {'station_id': 'b', 'longitude': 3.0, 'latitude': 43.0}
+    ]
+    monkeypatch.setattr(airquality, 'stations', far_apart)
+    response = client.get('/grid', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 422
+    assert 'bbox' in body['errors']['query']
+
+def test_far_from_stations(client):
+    """Cells far from every station should be returned without a value"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'bbox': '10,10,11,11',
+        'resolution': 0.05
+    }
+    response = client.get('/grid', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 200
+    assert body['total_rows'] > 0
+    assert all(row['avg_so2'] is None for row in body['rows'])
+
+@pytest.mark.parametrize('measurement', ['sum', 'count'])
+def test_measurement_not_interpolated(client, measurement):
+    """Sums and counts should not be interpolated and return an error for measurement"""
+    params = {
+        'variable': 'so2',
+        'measurement': measurement,
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00'
+    }
+    response = client.get('/grid', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 422
+    assert 'measurement' in body['errors']['query']
+
+def test_stations_bbox_without_coordinates(monkeypatch):
+    """Stations without coordinates should not count for the default bbox"""
+    stations = [
+        {'station_id': 'a', 'longitude': -3.7, 'latitude': 40.4},
+        {'station_id': 'b', 'longitude': None, 'latitude': None}
+    ]
+    monkeypatch.setattr(airquality, 'stations', stations)
+    assert airquality.stations_bbox() == pytest.approx([-3.75, 40.35, -3.65, 40.45])
@@ -0,0 +1,54 @@
+import random
+import pytest
+from airquality.stations import StationIndex, haversine
+
+@pytest.fixture
+def stations():
+    generator = random.Random(0)
+    return [
+        {'station_id': f'station_{i}', 'longitude': generator.uniform(-10, 5), 'latitude': generator.uniform(35, 44)}
+        for i in range(200)
+    ]
+
+def brute_force(stations, longitude, latitude):
+    distances = {
+        station['station_id']: haversine(longitude, latitude, station['longitude'], station['latitude'])
+        for station in stations
+    }
+    return sorted(distances.items(), key=lambda item: item[1])
+
+def test_haversine():
+    """The distance between Madrid and Barcelona should be about 505 km"""
+    assert 500000 < haversine(-3.7038, 40.4168, 2.1734, 41.3851) < 510000
+
+def test_nearest(stations):
+    """The k nearest stations should match a brute force search, ordered by distance"""
+    result = StationIndex(stations).nearest(-3.7, 40.4, k=5)
+    assert list(result.items()) == brute_force(stations, -3.7, 40.4)[:5]
+
+def test_radius(stations):
+    """A radius query should return exactly the stations within the radius"""
+    result = StationIndex(stations).nearest(-3.7, 40.4, radius=200000)
+    expected = [item for item in brute_force(stations, -3.7, 40.4) if item[1] <= 200000]
+    assert len(expected) > 0
+    assert list(result.keys()) == [station_id for station_id, _ in expected]
+
+def test_k_and_radius(stations):
+    """With both k and radius, at most k stations within the radius should be returned"""
+    result = StationIndex(stations).nearest(-3.7, 40.4, k=3, radius=1)
+    assert result == {}
+    result = StationIndex(stations).nearest(-3.7, 40.4, k=3, radius=10000000)
+    assert len(result) == 3
+
+def test_allowed(stations):
+    """Only allowed stations should be considered"""
+    allowed = {'station_1', 'station_2', 'station_3'}
+    result = StationIndex(stations).nearest(-3.7, 40.4, k=2, allowed=allowed)
+    expected = [item for item in brute_force(stations, -3.7, 40.4) if item[0] in allowed][:2]
+    assert list(result.items()) == expected
+
+def test_stations_without_coordinates(stations):
+    """Stations without coordinates should be skipped instead of breaking the index"""
+    index = StationIndex(stations + [{'station_id': 'no_geom', 'longitude': None, 'latitude': None}])
+    assert 'no_geom' not in index.stations
+    assert list(index.nearest(-3.7, 40.4, k=5).items()) == brute_force(stations, -3.7, 40.4)[:5]
@@ -90,6 +90,41 @@ def test_geom_filter(client):
     for row in body['rows']:
         assert row['station_id'] in ['aq_jaen', 'aq_salvia', 'aq_nevero']
 
+def test_near_filter(client):
+    """With near and k, only the k closest stations should appear in the result, with their distance"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'step': 'day',
+        'near': '-3.6343,40.5423',
+        'k': 2
+    }
+    response = client.get('/timeseries', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 200
+    assert len(set(row['station_id'] for row in body['rows'])) == 2
+    for row in body['rows']:
+        assert 'distance' in row
+    assert body['rows'] == sorted(body['rows'], key=lambda row: row['distance'])
+
+def test_near_filter_small_radius(client):
+    """With near and a radius that contains no station, no rows should be returned"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'step': 'day',
+        'near': '0,0',
+        'radius': 1000
+    }
+    response = client.get('/timeseries', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 200
+    assert body['total_rows'] == 0
+
 def test_stations_and_geom_filter(client):
     """With the given stations and geom filters, only 2 station should appear in the result"""
     params = {
@@ -299,3 +334,33 @@ def test_geom_filter_invalid_json(client):
     body = json.loads(response.data)
     assert response.status_code == 422
     assert 'geom' in body['errors']['query']
+
+def test_near_invalid_coordinates(client):
+    """A request with near outside of the valid coordinate range should return an error for that parameter"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'step': 'day',
+        'near': '-3.6343,140.5423'
+    }
+    response = client.get('/timeseries', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 422
+    assert 'near' in body['errors']['query']
+
+def test_k_without_near(client):
+    """A request with k but without near should return an error for k"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'step': 'day',
+        'k': 3
+    }
+    response = client.get('/timeseries', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 422
+    assert 'k' in body['errors']['query']
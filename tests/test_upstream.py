@@ -0,0 +1,306 @@
+import json
+import threading
+import time
+import pytest
+import requests
+import airquality
+from airquality import upstream
+from airquality.admission import AdmissionController
+from airquality.upstream import CircuitBreaker, CircuitOpenError, ResponseCache, UpstreamError
+
+@pytest.fixture
+def client():
+    with airquality.app.test_client() as client:
+        yield client
+
+@pytest.fixture
+def fresh_state(monkeypatch):
+    """Replaces the module-level cache, breaker and rate limits, and waits for background refreshes before undoing
+    patches"""
+    monkeypatch.setattr(upstream, 'cache', ResponseCache())
+    monkeypatch.setattr(airquality, 'admission_controller', AdmissionController())
+    monkeypatch.setattr(upstream, 'breaker', CircuitBreaker())
+    yield
+    while upstream.refreshing:
+        time.sleep(0.01)
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+def succeed():
+    return 'ok'
+
+def fail():
+    raise UpstreamError('failed')
+
+def slow():
+    time.sleep(0.02)
+    return 'ok'
+
+# Circuit breaker ------------------------------------------------------------------------------------------------------
+
+def test_breaker_stays_closed_on_success():
+    """Successful calls should pass through a closed breaker"""
+    breaker = CircuitBreaker(window=4, min_calls=2)
+    for _ in range(10):
+        assert breaker.call(succeed) == 'ok'
+    assert breaker.state == 'closed'
+
+def test_breaker_opens_on_errors():
+    """Once the error rate crosses the threshold, calls should fail fast with a Retry-After header"""
+    breaker = CircuitBreaker(window=4, min_calls=2, error_rate=0.5, reset_timeout=30)
+    for _ in range(2):
+        with pytest.raises(UpstreamError):
+            breaker.call(fail)
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError) as err:
+        breaker.call(succeed)
+    assert err.value.code == 503
+    assert int(err.value.headers['Retry-After']) > 0
+
+def test_breaker_opens_on_slow_calls():
+    """Once the share of slow calls crosses the threshold, the breaker should open"""
+    breaker = CircuitBreaker(window=4, min_calls=2, slow_call=0.01, slow_rate=0.5)
+    breaker.call(slow)
+    breaker.call(slow)
+    assert breaker.state == 'open'
+
+def test_breaker_closes_after_successful_trial():
+    """After the reset timeout, a successful trial call should close the breaker"""
+    breaker = CircuitBreaker(window=4, min_calls=1, reset_timeout=0.01)
+    with pytest.raises(UpstreamError):
+        breaker.call(fail)
+    time.sleep(0.02)
+    assert breaker.call(succeed) == 'ok'
+    assert breaker.state == 'closed'
+
+def test_breaker_reopens_after_failed_trial():
+    """After the reset timeout, a failed trial call should open the breaker again"""
+    breaker = CircuitBreaker(window=4, min_calls=1, reset_timeout=0.01)
+    with pytest.raises(UpstreamError):
+        breaker.call(fail)
+    time.sleep(0.02)
+    with pytest.raises(UpstreamError):
+        breaker.call(fail)
+    assert breaker.state == 'open'
+
+def test_breaker_recovers_from_unexpected_trial_error():
+    """A trial call raising something other than UpstreamError should reopen the breaker, not block it forever"""
+    breaker = CircuitBreaker(window=4, min_calls=1, reset_timeout=0.01)
+    with pytest.raises(UpstreamError):
+        breaker.call(fail)
+    time.sleep(0.02)
+    with pytest.raises(KeyError):
+        breaker.call(lambda: {}['missing'])
+    assert breaker.state == 'open'
+    assert not breaker.trial_in_flight
+    time.sleep(0.02)
+    assert breaker.call(succeed) == 'ok'
+    assert breaker.state == 'closed'
+
+# Response cache -------------------------------------------------------------------------------------------------------
+
+def test_cache_returns_age():
+    """A cached body should be returned together with its age"""
+    cache = ResponseCache()
+    cache.set('query', {'rows': []})
+    body, age = cache.get('query')
+    assert body == {'rows': []}
+    assert age >= 0
+
+def test_cache_expires_entries():
+    """Entries older than stale_for should no longer be returned"""
+    cache = ResponseCache(stale_for=0.01)
+    cache.set('query', {'rows': []})
+    time.sleep(0.02)
+    assert cache.get('query') is None
+
+def test_cache_evicts_least_recently_used():
+    """When the cache is full, the least recently used entry should be evicted"""
+    cache = ResponseCache(max_bytes=20)
+    cache.set('a', b'0123456789')
+    cache.set('b', b'0123456789')
+    cache.get('a')
+    cache.set('c', b'0123456789')
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.size == 20
+
+def test_cache_bounded_by_size():
+    """Bodies are counted by the size of their JSON encoding, and bodies larger than the cache are not stored"""
+    cache = ResponseCache(max_bytes=100)
+    cache.set('small', {'rows': []})
+    assert cache.size == len('{"rows": []}')
+    cache.set('large', {'rows': ['x' * 100]})
+    assert cache.get('large') is None
+    assert cache.get('small') is not None
+
+# Cached queries -------------------------------------------------------------------------------------------------------
+
+def test_cached_query_fresh(monkeypatch, fresh_state):
+    """A fresh cached body should be returned without querying the upstream again"""
+    calls = []
+    monkeypatch.setattr(upstream, 'send_query', lambda query: calls.append(query) or {'rows': [1]})
+    assert upstream.cached_query('query') == ({'rows': [1]}, None)
+    assert upstream.cached_query('query') == ({'rows': [1]}, None)
+    assert len(calls) == 1
+
+def test_cached_query_stale(monkeypatch, fresh_state):
+    """A stale body should be returned with its age, while exactly one background refresh runs"""
+    calls = []
+    release = threading.Event()
+
+    def send_query(query):
+        calls.append(query)
+        if len(calls) > 1:
+            release.wait(1)
+        return {'rows': [len(calls)]}
+
+    monkeypatch.setattr(upstream, 'send_query', send_query)
+    monkeypatch.setattr(upstream, 'cache_fresh_for', 0)
+    upstream.cached_query('query')
+    for _ in range(3):
+        body, age = upstream.cached_query('query')
+        assert body == {'rows': [1]}
+        assert age is not None and age >= 0
+    release.set()
+    while upstream.refreshing:
+        time.sleep(0.01)
+    assert len(calls) == 2
+    assert upstream.cached_query('query')[0] == {'rows': [2]}
+
+def test_cached_query_error_body(monkeypatch, fresh_state):
+    """A body with an SQL error should raise UpstreamError, without the error of the upstream, and not be cached"""
+    monkeypatch.setattr(upstream, 'send_query', lambda query: {'error': ['syntax error at or near "SELECT"']})
+    with pytest.raises(UpstreamError) as err:
+        upstream.cached_query('query')
+    assert 'SELECT' not in str(err.value)
+    assert upstream.cache.get('query') is None
+
+# Upstream responses ---------------------------------------------------------------------------------------------------
+
+@pytest.mark.parametrize('status_code', [500, 503, 429])
+def test_send_query_error_status(monkeypatch, status_code):
+    """Server errors and rate limiting by the upstream should raise UpstreamError"""
+    monkeypatch.setattr(upstream.requests, 'get', lambda **kwargs: FakeResponse(status_code, '{}'))
+    with pytest.raises(UpstreamError):
+        upstream.send_query('query')
+
+def test_send_query_invalid_json(monkeypatch):
+    """A response that is not JSON should raise UpstreamError"""
+    monkeypatch.setattr(upstream.requests, 'get', lambda **kwargs: FakeResponse(200, '<html>'))
+    with pytest.raises(UpstreamError):
+        upstream.send_query('query')
+
+def test_send_query_sql_error(monkeypatch):
+    """SQL errors reported by the upstream should be returned as part of the body"""
+    monkeypatch.setattr(upstream.requests, 'get', lambda **kwargs: FakeResponse(400, '{"error": ["syntax error"]}'))
+    assert upstream.send_query('query') == {'error': ['syntax error']}
+
+def test_send_query_unreachable(monkeypatch):
+    """A connection error should raise UpstreamError, without the url and query in its message"""
+    def get(**kwargs):
+        raise requests.ConnectionError('https://carto.example/api/v2/sql?q=SELECT+station_id')
+    monkeypatch.setattr(upstream.requests, 'get', get)
+    with pytest.raises(UpstreamError) as err:
+        upstream.send_query('query')
+    assert 'SELECT' not in str(err.value)
+
+# Endpoints ------------------------------------------------------------------------------------------------------------
+
+def test_stale_response_headers(client, monkeypatch, fresh_state):
+    """A stale response should carry Age and Warning headers"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00'
+    }
+    monkeypatch.setattr(upstream, 'send_query', lambda query: {'rows': [], 'total_rows': 0})
+    monkeypatch.setattr(upstream, 'cache_fresh_for', 0)
+    response = client.get('/measurements', query_string=params)
+    assert response.status_code == 200
+    assert 'Age' not in response.headers
+    response = client.get('/measurements', query_string=params)
+    assert response.status_code == 200
+    assert int(response.headers['Age']) >= 0
+    assert response.headers['Warning'] == '110 - "Response is Stale"'
+
+def test_upstream_failure_response(client, monkeypatch, fresh_state):
+    """An upstream failure should return a 502 with a JSON error"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00'
+    }
+    def send_query(query):
+        raise UpstreamError('The CARTO SQL API could not be reached.')
+    monkeypatch.setattr(upstream, 'send_query', send_query)
+    response = client.get('/measurements', query_string=params)
+    body = json.loads(response.data)
+    assert response.status_code == 502
+    assert body['errors'] == ['The CARTO SQL API could not be reached.']
+
+def test_stale_geom_response_while_upstream_fails(client, monkeypatch, fresh_state):
+    """A stale response for a geom filter should be served while the upstream fails, without validating the geom"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'geom': '{"type":"Point","coordinates":[-3.6343,40.5423]}'
+    }
+    airquality.geojson_errors.cache_clear()
+    monkeypatch.setattr(upstream, 'send_query', lambda query: {'rows': [], 'total_rows': 0})
+    monkeypatch.setattr(upstream, 'cache_fresh_for', 0)
+    assert client.get('/measurements', query_string=params).status_code == 200
+    airquality.geojson_errors.cache_clear()
+    def send_query(query):
+        raise UpstreamError('The CARTO SQL API could not be reached.')
+    monkeypatch.setattr(upstream, 'send_query', send_query)
+    for _ in range(10):
+        response = client.get('/measurements', query_string=params)
+        assert response.status_code == 200
+        assert 'Age' in response.headers
+
+def test_geom_validated_once(client, monkeypatch, fresh_state):
+    """A geom should only be sent to the upstream for validation the first time it is used"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'geom': '{"type":"Point","coordinates":[-3.6343,40.5423]}'
+    }
+    queries = []
+    airquality.geojson_errors.cache_clear()
+    monkeypatch.setattr(upstream, 'send_query', lambda query: queries.append(query) or {'rows': [], 'total_rows': 0})
+    for day in range(2, 5):
+        params['to'] = f'2017-07-0{day}T00:00:00'
+        assert client.get('/measurements', query_string=params).status_code == 200
+    assert len([query for query in queries if 'JOIN' not in query]) == 1
+    assert len([query for query in queries if 'JOIN' in query]) == 3
+
+def test_invalid_geom_not_fetched(client, monkeypatch, fresh_state):
+    """An invalid geom should return an error for that parameter, without querying the measurements"""
+    params = {
+        'variable': 'so2',
+        'measurement': 'avg',
+        'from': '2017-06-01T00:00:00',
+        'to': '2017-07-01T00:00:00',
+        'geom': '{"type":"Invalid"}'
+    }
+    queries = []
+    airquality.geojson_errors.cache_clear()
+    monkeypatch.setattr(upstream, 'send_query', lambda query: queries.append(query) or {'error': ['invalid GeoJSON']})
+    response = client.get('/timeseries', query_string=dict(params, step='day'))
+    body = json.loads(response.data)
+    assert response.status_code == 422
+    assert body['errors']['query']['geom'] == ['invalid GeoJSON']
+    assert len(queries) == 1